@@ -3,36 +3,466 @@ Flask Web Application for Text-to-Image Generation
 Optimized for Lightning.ai deployment
 """
 
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, abort, request, send_file, send_from_directory
+import base64
+import gzip
+import hashlib
+import io
+import orjson
 import os
+import queue
+import re
+import shutil
 import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from urllib.parse import quote
+
+from PIL import Image
 
 # Add src to path
 sys.path.insert(0, os.path.dirname(__file__))
 
-from src.pipeline.pipeline import GenerativeAIPipeline
 from src.utils.config import Config
-from src.utils.image_utils import pil_to_base64, enhance_prompt
+from src.utils.image_utils import enhance_prompt
+
+# Inference steps per quality level
+STEPS_MAP = {
+    'high': Config.HIGH_QUALITY_STEPS,
+    'medium': Config.MEDIUM_QUALITY_STEPS,
+    'low': Config.LOW_QUALITY_STEPS
+}
+
+# enhance_prompt is pure; memoize it since example chips and retries repeat prompts
+_cached_enhance_prompt = lru_cache(maxsize=1024)(enhance_prompt)
 
 # Initialize Flask app
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max request
 
+# Shared pool for PIL encoding, which releases the GIL
+_ENCODE_POOL = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='image-encode')
+
+# Transport encodings: format -> (mimetype, file extension, PIL save options)
+IMAGE_FORMATS = {
+    'WEBP': ('image/webp', 'webp', {'quality': 90, 'method': 4}),
+    'JPEG': ('image/jpeg', 'jpg', {'quality': 90, 'progressive': True}),
+    'PNG': ('image/png', 'png', {'compress_level': 1}),
+}
+DEFAULT_IMAGE_FORMAT = 'WEBP'
+
+# The lossless copy persisted once per generation; other formats are transcoded from it
+CANONICAL_PNG_OPTIONS = {'compress_level': 6}
+
+# Persisted results served from /images/<name>; see cached_image_path().
+# Resolved once: send_from_directory would resolve a relative path against
+# app.root_path, while the cache files are written relative to the cwd
+CACHE_DIR = os.path.abspath(Config.OUTPUT_DIR)
+CACHED_IMAGE_NAME = re.compile(
+    r'[0-9a-f]{32}\.(%s)' % '|'.join(extension for _, extension, _ in IMAGE_FORMATS.values())
+)
+CACHED_IMAGE_MIMETYPES = {extension: mimetype for mimetype, extension, _ in IMAGE_FORMATS.values()}
+
+# When set (e.g. '/protected-images/'), /images/ responses delegate the file
+# transfer to nginx via X-Accel-Redirect instead of streaming it from Python
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '')
+
+
+def _json(obj, status=200):
+    """JSON response encoded with orjson, which is much faster on large base64 payloads"""
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+
+
+# Per-thread encode buffer, reused across requests instead of reallocated
+_ENCODE_BUFFERS = threading.local()
+
+
+def parse_image_format(data):
+    """Read the requested transport format from a JSON payload"""
+    fmt = str(data.get('format', DEFAULT_IMAGE_FORMAT)).upper()
+    if fmt == 'JPG':
+        fmt = 'JPEG'
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported format '{fmt}', expected one of {', '.join(IMAGE_FORMATS)}")
+    return fmt
+
+
+def _encode_to_buffer(image, fmt, options=None):
+    """Encode a PIL image into this thread's reusable buffer and return the buffer"""
+    if fmt == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    buf = getattr(_ENCODE_BUFFERS, 'buf', None)
+    if buf is None:
+        buf = _ENCODE_BUFFERS.buf = io.BytesIO()
+    buf.seek(0)
+    buf.truncate(0)
+    image.save(buf, format=fmt, **(IMAGE_FORMATS[fmt][2] if options is None else options))
+    return buf
+
+
+def encode_image(image, fmt=DEFAULT_IMAGE_FORMAT):
+    """Encode a PIL image to bytes using this thread's reusable buffer"""
+    return _encode_to_buffer(image, fmt).getvalue()
+
+
+def encode_canonical_png(image):
+    """Encode the lossless PNG copy that is persisted for each generation"""
+    return _encode_to_buffer(image, 'PNG', CANONICAL_PNG_OPTIONS).getvalue()
+
+
+def encode_image_base64(image, fmt=DEFAULT_IMAGE_FORMAT):
+    """Encode a PIL image straight to a base64 string"""
+    buf = _encode_to_buffer(image, fmt)
+    # b64encode reads the buffer's memoryview directly, skipping the bytes copy.
+    # The view must be released before the buffer is truncated again.
+    with buf.getbuffer() as view:
+        return base64.b64encode(view).decode('ascii')
+
+
+def encode_when_ready(image_future, fmt=DEFAULT_IMAGE_FORMAT, encoder=encode_image):
+    """
+    Chain encoding onto a generation Future.
+
+    The encode is submitted to _ENCODE_POOL as soon as the image is ready, so
+    it overlaps with the next GPU batch. Returns a Future of the encoded result.
+    """
+    encoded = Future()
+
+    def _copy_result(encode_future):
+        try:
+            encoded.set_result(encode_future.result())
+        except Exception as e:
+            encoded.set_exception(e)
+
+    def _on_image(done):
+        try:
+            image = done.result()
+        except Exception as e:
+            encoded.set_exception(e)
+            return
+        _ENCODE_POOL.submit(encoder, image, fmt).add_done_callback(_copy_result)
+
+    image_future.add_done_callback(_on_image)
+    return encoded
+
+
 # Global pipeline instance (lazy loading)
 pipeline = None
+_PIPELINE_LOCK = threading.Lock()
 
 
 def get_pipeline():
     """Lazy load the pipeline to avoid startup delays"""
     global pipeline
     if pipeline is None:
-        print("🔄 Initializing AI Pipeline...")
-        Config.ensure_directories()
-        pipeline = GenerativeAIPipeline(model_name=Config.MODEL_NAME)
-        print("✅ Pipeline initialized!")
+        # Double-checked so concurrent first requests build the model only once
+        with _PIPELINE_LOCK:
+            if pipeline is None:
+                # Imported here so torch/diffusers only load when the model is needed
+                from src.pipeline.pipeline import GenerativeAIPipeline
+
+                print("🔄 Initializing AI Pipeline...")
+                Config.ensure_directories()
+                pipeline = GenerativeAIPipeline(model_name=Config.MODEL_NAME)
+                print("✅ Pipeline initialized!")
     return pipeline
 
 
+def warmup_pipeline():
+    """Load the pipeline and run a 1-step generation so kernels are warm before traffic"""
+    pipe = get_pipeline()
+    print("🔥 Warming up pipeline...")
+    # Through the batcher so it never runs on the GPU alongside real requests
+    batcher.submit(
+        "warmup",
+        Config.DEFAULT_WIDTH,
+        Config.DEFAULT_HEIGHT,
+        1,
+        Config.DEFAULT_GUIDANCE_SCALE
+    ).result()
+    print("✅ Warmup complete!")
+    return pipe
+
+
+def start_background_warmup():
+    """
+    Warm the pipeline on a daemon thread so the server can accept connections
+    (and answer /health) during a cold model load. Requests that need the
+    model meanwhile wait in get_pipeline().
+    """
+    def _warmup():
+        try:
+            warmup_pipeline()
+        except Exception as e:
+            # Not fatal: the next /generate retries the load lazily
+            print(f"Pipeline warmup failed: {e}")
+
+    thread = threading.Thread(target=_warmup, name='pipeline-warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def make_generators(seeds):
+    """Build one torch.Generator per prompt; None seeds get a random seed"""
+    import torch
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    generators = []
+    for seed in seeds:
+        generator = torch.Generator(device)
+        if seed is None:
+            generator.seed()
+        else:
+            generator.manual_seed(seed)
+        generators.append(generator)
+    return generators
+
+
+class GenerationBatcher:
+    """
+    Coalesces concurrent generation requests into batched pipeline calls.
+
+    Requests sharing the same (width, height, steps, guidance) bucket that
+    arrive within ``batch_wait_timeout_s`` of each other are run as one
+    ``pipe.system.generate([...])`` call of up to ``max_batch`` prompts.
+    """
+
+    def __init__(self, max_batch=4, batch_wait_timeout_s=0.05):
+        self.max_batch = max_batch
+        self.batch_wait_timeout_s = batch_wait_timeout_s
+        self._queue = queue.Queue()
+        self._pending = deque()  # Items drained while filling a different bucket
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def submit(self, prompt, width, height, num_steps, guidance_scale, seed=None):
+        """
+        Queue a prompt for generation; returns a Future resolving to a PIL image.
+
+        When ``seed`` is given the image is generated with a generator seeded
+        from it, so identical submissions produce identical images.
+        """
+        self._ensure_worker()
+        future = Future()
+        self._queue.put(((width, height, num_steps, guidance_scale), prompt, seed, future))
+        return future
+
+    def _ensure_worker(self):
+        # Started lazily so forking servers get the thread in the worker process
+        if self._worker is None:
+            with self._worker_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name='generation-batcher', daemon=True)
+                    self._worker.start()
+
+    def _next_item(self, timeout=None):
+        if self._pending:
+            return self._pending.popleft()
+        return self._queue.get(timeout=timeout)
+
+    def _collect_batch(self):
+        first = self._next_item()
+        bucket = first[0]
+        batch = [first]
+
+        # Pick up matching items left over from a previous bucket first
+        leftovers = deque()
+        while self._pending:
+            item = self._pending.popleft()
+            if item[0] == bucket and len(batch) < self.max_batch:
+                batch.append(item)
+            else:
+                leftovers.append(item)
+        self._pending = leftovers
+
+        deadline = time.monotonic() + self.batch_wait_timeout_s
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item[0] == bucket:
+                batch.append(item)
+            else:
+                self._pending.append(item)
+
+        return bucket, batch
+
+    def _generate(self, bucket, batch):
+        width, height, num_steps, guidance_scale = bucket
+        prompts = [prompt for _, prompt, _, _ in batch]
+        seeds = [seed for _, _, seed, _ in batch]
+
+        kwargs = {}
+        if any(seed is not None for seed in seeds):
+            kwargs['generator'] = make_generators(seeds)
+        images = get_pipeline().system.generate(
+            prompts,
+            num_inference_steps=num_steps,
+            guidance_scale=guidance_scale,
+            width=width,
+            height=height,
+            **kwargs
+        )
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+        if len(images) != len(prompts):
+            raise RuntimeError(f'Pipeline returned {len(images)} images for {len(prompts)} prompts')
+        return images
+
+    def _run(self):
+        while True:
+            futures = []
+            # Any failure must resolve every waiting Future and keep the worker alive,
+            # otherwise callers (and their _BATCH_SLOTS permits) block forever
+            try:
+                bucket, batch = self._collect_batch()
+                futures = [future for _, _, _, future in batch]
+                images = self._generate(bucket, batch)
+                for future, image in zip(futures, images):
+                    future.set_result(image)
+            except Exception as e:
+                print(f"Error in batched generation: {e}")
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+
+batcher = GenerationBatcher()
+
+
+class ImageCache:
+    """Bounded, thread-safe LRU cache of encoded images"""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+image_cache = ImageCache()
+
+
+class InflightGenerations:
+    """Shares one pending generation between identical concurrent requests"""
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def get_or_start(self, key, start):
+        """Return the Future already running for ``key``, or the one ``start()`` creates"""
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                return future
+            future = self._futures[key] = start()
+        # Outside the lock: the callback runs immediately if already done
+        future.add_done_callback(lambda done: self._discard(key, done))
+        return future
+
+    def _discard(self, key, future):
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+
+inflight_generations = InflightGenerations()
+
+
+def generation_key(enhanced_prompt, width, height, num_steps, preview=False, seed=None):
+    """Stable digest identifying a generation request"""
+    seed_part = '' if seed is None else seed
+    return hashlib.blake2b(
+        f'{enhanced_prompt}|{width}|{height}|{num_steps}|{int(preview)}|{seed_part}'.encode('utf-8'),
+        digest_size=16
+    ).digest()
+
+
+def cached_image_path(key, fmt):
+    """Location of the on-disk copy of a generation result"""
+    return os.path.join(CACHE_DIR, f'{key.hex()}.{IMAGE_FORMATS[fmt][1]}')
+
+
+def read_cached_image(key, fmt):
+    """Return the on-disk copy of a result, or None if it hasn't been generated"""
+    try:
+        with open(cached_image_path(key, fmt), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_cached_image(key, fmt, image_bytes):
+    """Persist a result so it survives restarts; written atomically"""
+    path = cached_image_path(key, fmt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(image_bytes)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Don't leave partial files behind in the (unevicted) cache directory
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def persist_cached_image(key, fmt, image_bytes):
+    """Make sure a result is on disk; returns False if it couldn't be written"""
+    if os.path.exists(cached_image_path(key, fmt)):
+        return True
+    try:
+        write_cached_image(key, fmt, image_bytes)
+    except OSError as e:
+        print(f"Could not persist generated image: {e}")
+        return False
+    return True
+
+
+def load_canonical_image(key):
+    """Open the persisted lossless copy of a result as a PIL image, or None"""
+    try:
+        with open(cached_image_path(key, 'PNG'), 'rb') as f:
+            image = Image.open(f)
+            image.load()
+            return image
+    except FileNotFoundError:
+        return None
+
+
+def cached_image_url(key, fmt):
+    """URL the persisted copy of a result is served from"""
+    return f'/images/{os.path.basename(cached_image_path(key, fmt))}'
+
+
+def seed_from_key(key):
+    """Deterministic generator seed derived from a generation key"""
+    return int.from_bytes(key[:8], 'big') & 0x7FFFFFFFFFFFFFFF
+
+
 # HTML Template
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -319,6 +749,7 @@ HTML_TEMPLATE = """
 
     <script>
         let currentImageData = null;
+        let lastSettings = null;
         
         function setPrompt(text) {
             document.getElementById('prompt').value = text;
@@ -348,6 +779,12 @@ HTML_TEMPLATE = """
                 </div>
             `;
 
+            // Same settings again means "give me another variation": send a new
+            // seed. A first request omits it so repeats hit the server cache.
+            const settings = JSON.stringify([prompt, quality, size]);
+            const seed = settings === lastSettings ? Math.floor(Math.random() * 2147483647) : undefined;
+            lastSettings = settings;
+
             try {
                 const response = await fetch('/generate', {
                     method: 'POST',
@@ -356,7 +793,9 @@ HTML_TEMPLATE = """
                         prompt: prompt,
                         quality: quality,
                         width: size,
-                        height: size
+                        height: size,
+                        format: 'webp',
+                        seed: seed
                     })
                 });
 
@@ -365,11 +804,13 @@ HTML_TEMPLATE = """
                 if (data.error) {
                     resultDiv.innerHTML = `<div class="error">❌ Error: ${data.error}</div>`;
                 } else {
-                    currentImageData = data.image;
+                    // Served from /images/ when persisted, inline base64 otherwise
+                    currentImageData = data.image_url || `data:${data.mimetype};base64,${data.image}`;
+                    const extension = data.mimetype.split('/')[1].replace('jpeg', 'jpg');
                     resultDiv.innerHTML = `
                         <h3 style="color: #667eea; margin-bottom: 15px;">✨ Generated Successfully!</h3>
-                        <img src="data:image/png;base64,${data.image}" alt="Generated Image" class="result-image">
-                        <a href="data:image/png;base64,${data.image}" download="ai_generated_${Date.now()}.png" class="download-btn">
+                        <img src="${currentImageData}" alt="Generated Image" class="result-image">
+                        <a href="${currentImageData}" download="ai_generated_${Date.now()}.${extension}" class="download-btn">
                             📥 Download Image
                         </a>
                         <div class="metrics">
@@ -377,6 +818,7 @@ HTML_TEMPLATE = """
                             <p><strong>Prompt:</strong> ${data.prompt}</p>
                             <p><strong>Size:</strong> ${data.width}x${data.height}</p>
                             <p><strong>Steps:</strong> ${data.steps}</p>
+                            <p><strong>Seed:</strong> ${data.seed}</p>
                             <p style="margin-top: 10px; color: #666;">
                                 ✓ Using attention mechanisms for text-image alignment
                             </p>
@@ -404,106 +846,376 @@ HTML_TEMPLATE = """
 """
 
 
+# The template has no Jinja interpolation, so build the responses once at import
+_HTML_BYTES = HTML_TEMPLATE.encode('utf-8')
+_HTML_HEADERS = {
+    'Content-Type': 'text/html; charset=utf-8',
+    'Cache-Control': 'public, max-age=3600',
+    'Vary': 'Accept-Encoding',
+}
+_HTML_RESPONSE = (_HTML_BYTES, 200, _HTML_HEADERS)
+_HTML_GZIP_RESPONSE = (gzip.compress(_HTML_BYTES, 6), 200, {**_HTML_HEADERS, 'Content-Encoding': 'gzip'})
+
+
 @app.route('/')
 def home():
     """Render the main page"""
-    return render_template_string(HTML_TEMPLATE)
+    if request.accept_encodings['gzip'] > 0:
+        return _HTML_GZIP_RESPONSE
+    return _HTML_RESPONSE
+
+
+_HEALTH_HEADERS = {'Content-Type': 'application/json', 'Cache-Control': 'no-store'}
+_HEALTH_READY_RESPONSE = (
+    orjson.dumps({'status': 'healthy', 'service': 'text-to-image-generator', 'model': 'ready'}),
+    200,
+    _HEALTH_HEADERS
+)
+_HEALTH_LOADING_RESPONSE = (
+    orjson.dumps({'status': 'healthy', 'service': 'text-to-image-generator', 'model': 'loading'}),
+    200,
+    _HEALTH_HEADERS
+)
 
 
 @app.route('/health')
 def health():
-    """Health check endpoint for Lightning.ai"""
-    return jsonify({'status': 'healthy', 'service': 'text-to-image-generator'})
+    """Health check endpoint for Lightning.ai; never loads the model"""
+    if pipeline is None:
+        return _HEALTH_LOADING_RESPONSE
+    return _HEALTH_READY_RESPONSE
+
+
+# Input limits, checked before anything reaches the GPU
+ALLOWED_SIZES = frozenset({512, 768, 1024})
+QUALITY_LEVELS = frozenset(STEPS_MAP)
+MAX_PROMPT_LENGTH = 800
+MAX_SEED = 2 ** 63 - 1
+PREVIEW_MAX_SIZE = 512
+MAX_BATCH_PROMPTS = 5
+MAX_BATCH_PROMPT_CHARS = 4000
+BATCH_NUM_STEPS = 20
+
+# Caps /batch-generate prompts in flight across all clients so one batch
+# can't monopolize the batcher queue
+_BATCH_SLOTS = threading.BoundedSemaphore(MAX_BATCH_PROMPTS)
+
+
+def submit_batch_prompt(prompt):
+    """Queue one /batch-generate prompt on the shared batcher, bounded by _BATCH_SLOTS"""
+    _BATCH_SLOTS.acquire()
+    try:
+        future = batcher.submit(
+            _cached_enhance_prompt(prompt),
+            Config.DEFAULT_WIDTH,
+            Config.DEFAULT_HEIGHT,
+            BATCH_NUM_STEPS,
+            Config.DEFAULT_GUIDANCE_SCALE
+        )
+    except BaseException:
+        _BATCH_SLOTS.release()
+        raise
+    future.add_done_callback(lambda _: _BATCH_SLOTS.release())
+    return future
+
+
+def get_payload():
+    """Return the request's JSON object, raising ValueError if it isn't one"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ValueError('Request body must be a JSON object')
+    return data
+
+
+def validate_size(name, value):
+    """Check an image dimension is one of the supported sizes"""
+    # bool is an int subclass; reject it explicitly
+    if isinstance(value, bool) or not isinstance(value, int) or value not in ALLOWED_SIZES:
+        sizes = ', '.join(str(size) for size in sorted(ALLOWED_SIZES))
+        raise ValueError(f'{name} must be one of {sizes}')
+    return value
+
+
+def validate_seed(value):
+    """Check an optional generator seed is a non-negative integer"""
+    if value is None:
+        return None
+    # bool is an int subclass; reject it explicitly
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= MAX_SEED:
+        raise ValueError(f'seed must be an integer between 0 and {MAX_SEED}')
+    return value
+
+
+def validate_flag(name, value):
+    """Parse an on/off option; only booleans, 0/1 and "0"/"1" are accepted"""
+    if value is True or value is False or value is None:
+        return bool(value)
+    if type(value) is int and value in (0, 1):
+        return bool(value)
+    if value in ('0', '1'):
+        return value == '1'
+    raise ValueError(f'{name} must be true, false, 1 or 0')
+
+
+def preview_size(width, height):
+    """Generation size for a preview, keeping the aspect ratio and multiples of 8"""
+    scale = PREVIEW_MAX_SIZE / max(width, height)
+    if scale >= 1:
+        return width, height
+    return (
+        max(8, round(width * scale / 8) * 8),
+        max(8, round(height * scale / 8) * 8)
+    )
+
+
+def run_generation(data, fmt=DEFAULT_IMAGE_FORMAT, load_bytes=True):
+    """
+    Generate an image for a /generate-style JSON payload.
+
+    Returns (image_bytes, info) where image_bytes is the image encoded as
+    ``fmt`` and info holds the generation metadata, including ``image_url``
+    once the result is persisted under ``Config.OUTPUT_DIR``. Identical
+    requests are served from ``image_cache``, then from that copy, then by
+    transcoding the canonical PNG kept for every generation; with
+    ``load_bytes=False`` a persisted result isn't read back and image_bytes
+    is None. Raises ValueError for an invalid payload.
+
+    An optional integer ``seed`` selects the variation; without one the seed
+    is derived from the request, so repeats are cache hits. Concurrent
+    identical requests share a single generation.
+
+    With ``preview`` set (in the payload or as ``?preview=1``) the UNet runs
+    at no more than PREVIEW_MAX_SIZE and the result is Lanczos-upscaled to
+    the requested size.
+    """
+    prompt = data.get('prompt', '')
+    quality = data.get('quality', 'medium')
+    width = validate_size('width', data.get('width', Config.DEFAULT_WIDTH))
+    height = validate_size('height', data.get('height', Config.DEFAULT_HEIGHT))
+    preview = validate_flag('preview', data.get('preview', request.args.get('preview')))
+    seed = validate_seed(data.get('seed'))
+
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise ValueError('No prompt provided')
+    prompt = prompt.strip()
+
+    if len(prompt) > MAX_PROMPT_LENGTH:
+        raise ValueError(f'Prompt must be at most {MAX_PROMPT_LENGTH} characters')
+
+    if quality not in QUALITY_LEVELS:
+        raise ValueError(f"quality must be one of {', '.join(sorted(QUALITY_LEVELS))}")
+
+    # Get quality settings
+    num_steps = STEPS_MAP.get(quality, Config.MEDIUM_QUALITY_STEPS)
+
+    # Enhance prompt for better quality
+    enhanced_prompt = _cached_enhance_prompt(prompt, quality_level=quality)
+
+    info = {
+        'prompt': prompt,
+        'enhanced_prompt': enhanced_prompt,
+        'width': width,
+        'height': height,
+        'steps': num_steps,
+        'quality': quality,
+        'preview': preview,
+        'image_url': None
+    }
+
+    gen_width, gen_height = preview_size(width, height) if preview else (width, height)
+
+    key = generation_key(enhanced_prompt, width, height, num_steps, preview, seed)
+    if seed is None:
+        seed = seed_from_key(key)
+    info['seed'] = seed
+
+    image_bytes = image_cache.get((key, fmt))
+
+    if image_bytes is None and os.path.exists(cached_image_path(key, fmt)):
+        if not load_bytes:
+            info['image_url'] = cached_image_url(key, fmt)
+            return None, info
+        image_bytes = read_cached_image(key, fmt)
+
+    if image_bytes is None:
+        # Same key means same seed and pixels, so any format can be
+        # transcoded from the canonical PNG instead of regenerating
+        image = load_canonical_image(key)
+        if image is not None:
+            image_bytes = encode_image(image, fmt)
+
+    if image_bytes is None:
+        def start_generation():
+            # Queue for generation; concurrent requests are batched on the GPU.
+            # A fixed seed means a cached result matches a fresh one.
+            image_future = batcher.submit(
+                enhanced_prompt,
+                gen_width,
+                gen_height,
+                num_steps,
+                Config.DEFAULT_GUIDANCE_SCALE,
+                seed=seed
+            )
+
+            def finalize(image, _):
+                if (gen_width, gen_height) != (width, height):
+                    image = image.resize((width, height), Image.LANCZOS)
+                png_bytes = encode_canonical_png(image)
+                persist_cached_image(key, 'PNG', png_bytes)
+                return image, png_bytes
+
+            return encode_when_ready(image_future, 'PNG', finalize)
+
+        def encoder(result, fmt):
+            image, png_bytes = result
+            return png_bytes if fmt == 'PNG' else encode_image(image, fmt)
+
+        # Requests already waiting on this key reuse its generation
+        generation = inflight_generations.get_or_start(key, start_generation)
+        image_bytes = encode_when_ready(generation, fmt, encoder).result()
+
+    image_cache.put((key, fmt), image_bytes)
+    if persist_cached_image(key, fmt, image_bytes):
+        info['image_url'] = cached_image_url(key, fmt)
+    return image_bytes, info
 
 
 @app.route('/generate', methods=['POST'])
 def generate_image():
-    """Generate image from text prompt"""
+    """
+    Generate image from text prompt.
+
+    The image is returned by URL (``image_url``); base64 ``image`` data is
+    only included when the payload sets ``inline`` or the result couldn't
+    be persisted.
+    """
     try:
-        data = request.json
-        prompt = data.get('prompt', '').strip()
-        quality = data.get('quality', 'medium')
-        width = data.get('width', Config.DEFAULT_WIDTH)
-        height = data.get('height', Config.DEFAULT_HEIGHT)
-
-        if not prompt:
-            return jsonify({'error': 'No prompt provided'}), 400
-
-        # Get quality settings
-        steps_map = {
-            'high': Config.HIGH_QUALITY_STEPS,
-            'medium': Config.MEDIUM_QUALITY_STEPS,
-            'low': Config.LOW_QUALITY_STEPS
-        }
-        num_steps = steps_map.get(quality, Config.MEDIUM_QUALITY_STEPS)
-
-        # Enhance prompt for better quality
-        enhanced_prompt = enhance_prompt(prompt, quality_level=quality)
-
-        # Get pipeline and generate
-        pipe = get_pipeline()
-        image = pipe.system.generate(
-            enhanced_prompt,
-            num_inference_steps=num_steps,
-            guidance_scale=Config.DEFAULT_GUIDANCE_SCALE,
-            width=width,
-            height=height
-        )
+        data = get_payload()
+        fmt = parse_image_format(data)
+        inline = validate_flag('inline', data.get('inline'))
+        image_bytes, info = run_generation(data, fmt, load_bytes=inline)
 
-        # Convert to base64
-        img_base64 = pil_to_base64(image)
+        payload = {'format': fmt, 'mimetype': IMAGE_FORMATS[fmt][0], **info}
+        if inline or info['image_url'] is None:
+            payload['image'] = base64.b64encode(image_bytes).decode('ascii')
 
-        return jsonify({
-            'image': img_base64,
-            'prompt': prompt,
-            'enhanced_prompt': enhanced_prompt,
-            'width': width,
-            'height': height,
-            'steps': num_steps,
-            'quality': quality
-        })
+        return _json(payload)
 
+    except ValueError as e:
+        return _json({'error': str(e)}, status=400)
     except Exception as e:
         print(f"Error generating image: {e}")
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, status=500)
+
+
+@app.route('/generate_image', methods=['POST'])
+def generate_image_binary():
+    """Generate image from text prompt and return the encoded image bytes"""
+    try:
+        data = get_payload()
+        fmt = parse_image_format(data)
+        image_bytes, info = run_generation(data, fmt)
+
+        mimetype, extension, _ = IMAGE_FORMATS[fmt]
+        response = send_file(io.BytesIO(image_bytes), mimetype=mimetype)
+        response.headers['X-Extension'] = extension
+        response.headers['X-Prompt'] = quote(info['prompt'])
+        response.headers['X-Enhanced-Prompt'] = quote(info['enhanced_prompt'])
+        response.headers['X-Width'] = str(info['width'])
+        response.headers['X-Height'] = str(info['height'])
+        response.headers['X-Steps'] = str(info['steps'])
+        response.headers['X-Quality'] = str(info['quality'])
+        response.headers['X-Preview'] = '1' if info['preview'] else '0'
+        if info['image_url']:
+            response.headers['X-Image-Url'] = info['image_url']
+        return response
+
+    except ValueError as e:
+        return _json({'error': str(e)}, status=400)
+    except Exception as e:
+        print(f"Error generating image: {e}")
+        return _json({'error': str(e)}, status=500)
+
+
+@app.route('/images/<filename>')
+def cached_image(filename):
+    """Serve a persisted generation result with HTTP caching and Range support"""
+    match = CACHED_IMAGE_NAME.fullmatch(filename)
+    if not match:
+        abort(404)
+
+    if X_ACCEL_REDIRECT_PREFIX:
+        response = Response(mimetype=CACHED_IMAGE_MIMETYPES[match.group(1)])
+        response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX + filename
+        return response
+
+    return send_from_directory(
+        CACHE_DIR,
+        filename,
+        conditional=True,
+        etag=True,
+        max_age=86400
+    )
 
 
 @app.route('/batch-generate', methods=['POST'])
 def batch_generate():
-    """Generate multiple images from multiple prompts"""
+    """
+    Generate multiple images from multiple prompts.
+
+    Streams NDJSON: one ``{"index", "prompt", "image", "format"}`` line per
+    image, in completion order, or an ``{"index", "prompt", "error"}`` line
+    if that prompt failed.
+    """
     try:
-        data = request.json
+        data = get_payload()
         prompts = data.get('prompts', [])
         
         if not prompts or not isinstance(prompts, list):
-            return jsonify({'error': 'Invalid prompts list'}), 400
+            return _json({'error': 'Invalid prompts list'}, status=400)
         
-        if len(prompts) > 5:
-            return jsonify({'error': 'Maximum 5 prompts allowed per batch'}), 400
+        if len(prompts) > MAX_BATCH_PROMPTS:
+            return _json({'error': f'Maximum {MAX_BATCH_PROMPTS} prompts allowed per batch'}, status=400)
 
-        pipe = get_pipeline()
-        results = []
-        
-        for prompt in prompts:
-            enhanced = enhance_prompt(prompt)
-            image = pipe.system.generate(enhanced, num_inference_steps=20)
-            img_base64 = pil_to_base64(image)
-            results.append({
-                'prompt': prompt,
-                'image': img_base64
-            })
-        
-        return jsonify({'results': results})
+        if not all(isinstance(prompt, str) and prompt for prompt in prompts):
+            return _json({'error': 'Every prompt must be a non-empty string'}, status=400)
+
+        if sum(len(prompt) for prompt in prompts) > MAX_BATCH_PROMPT_CHARS:
+            return _json({'error': f'Prompts may total at most {MAX_BATCH_PROMPT_CHARS} characters'}, status=400)
+
+        fmt = parse_image_format(data)
+
+        # Dispatch through the shared batcher so concurrent batch and single
+        # requests are coalesced into the same GPU minibatches; each image is
+        # encoded as soon as its batch finishes
+        encode_futures = {
+            encode_when_ready(submit_batch_prompt(prompt), fmt, encode_image_base64): index
+            for index, prompt in enumerate(prompts)
+        }
+
+        def stream_results():
+            for future in as_completed(list(encode_futures)):
+                # Drop our reference so each base64 string can be freed once sent
+                index = encode_futures.pop(future)
+                try:
+                    line = {'index': index, 'prompt': prompts[index], 'image': future.result(), 'format': fmt}
+                except Exception as e:
+                    print(f"Error generating batch image: {e}")
+                    line = {'index': index, 'prompt': prompts[index], 'error': str(e)}
+                yield orjson.dumps(line) + b'\n'
+
+        return Response(stream_results(), mimetype='application/x-ndjson')
     
+    except ValueError as e:
+        return _json({'error': str(e)}, status=400)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _json({'error': str(e)}, status=500)
 
 
 if __name__ == '__main__':
     # Ensure directories exist
     Config.ensure_directories()
-    
-    # Run Flask app
+
     port = int(os.environ.get('PORT', Config.FLASK_PORT))
     print(f"\n{'='*70}")
     print(f"🚀 Starting AI Text-to-Image Generator")
@@ -512,7 +1224,24 @@ if __name__ == '__main__':
     print(f"📱 Lightning.ai will expose this automatically")
     print(f"📍 Look for 'Open' button or port {port} in Lightning.ai UI")
     print(f"{'='*70}\n")
+
+    # Hand off to gunicorn when available; it warms the pipeline via gunicorn.conf.py
+    gunicorn = shutil.which('gunicorn')
+    if gunicorn and not os.environ.get('USE_FLASK_DEV_SERVER'):
+        app_dir = os.path.dirname(os.path.abspath(__file__))
+        os.execv(gunicorn, [
+            gunicorn,
+            '--chdir', app_dir,
+            '--config', os.path.join(app_dir, 'gunicorn.conf.py'),
+            '--bind', f'0.0.0.0:{port}',
+            'app:app'
+        ])
+
+    # Load model weights in the background so the first request doesn't pay
+    # for it, while the server is already answering /health
+    start_background_warmup()
     
+    # Fall back to the Flask dev server
     app.run(
         host='0.0.0.0',  # CRITICAL: Must bind to 0.0.0.0 for Lightning.ai
         port=port,
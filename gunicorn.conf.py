@@ -0,0 +1,25 @@
+"""
+Gunicorn configuration for the Text-to-Image Generator
+Run with: gunicorn --config gunicorn.conf.py app:app
+"""
+
+import os
+
+# A single worker process owns the CUDA context and the model; concurrency
+# comes from threads that wait on the generation batcher
+bind = f"0.0.0.0:{os.environ.get('PORT', '7860')}"
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+timeout = 300
+graceful_timeout = 30
+keepalive = 5
+
+
+def post_worker_init(worker):
+    """Start warming the pipeline without delaying the worker's first request"""
+    from app import start_background_warmup
+
+    # Not joined: a cold model download can outlast `timeout`, and the worker
+    # must keep heartbeating and answering /health meanwhile
+    start_background_warmup()